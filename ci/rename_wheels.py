@@ -0,0 +1,20 @@
+import os
+import sys
+
+
+def _iter_wheels(dist):
+    with os.scandir(dist) as it:
+        for entry in it:
+            if entry.name.endswith(".whl") and entry.is_file(follow_symlinks=False):
+                yield entry
+
+
+def rename_wheels(dist):
+    # py-spy doesn't link against python, so the same wheel works for python 2 and 3
+    for wheel in list(_iter_wheels(dist)):
+        if "py2" not in wheel.name:
+            os.replace(wheel.path, os.path.join(dist, wheel.name.replace("py3", "py2.py3")))
+
+
+if __name__ == "__main__":
+    rename_wheels(sys.argv[1] if len(sys.argv) > 1 else "dist")
@@ -1,20 +1,53 @@
+import functools
+import io
 import requests
 import pathlib
 import re
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 _VERSIONS_URL = "https://raw.githubusercontent.com/actions/python-versions/main/versions-manifest.json"  # noqa
+_VERSION_SPLIT = re.compile(r"\W")
+_CACHE_DIR = pathlib.Path.home() / ".cache" / "py-spy"
+_SESSION = requests.Session()
 
 
+@functools.lru_cache(maxsize=None)
 def parse_version(v):
-    return tuple(int(part) for part in re.split("\W", v)[:3])
+    return tuple(int(part) for part in _VERSION_SPLIT.split(v)[:3])
+
+
+def get_versions_manifest():
+    # the manifest rarely changes, so keep a copy around and only download
+    # it again when the etag doesn't match
+    manifest = _CACHE_DIR / "versions-manifest.json"
+    etag = _CACHE_DIR / "versions-manifest.etag"
+
+    headers = {}
+    if manifest.exists() and etag.exists():
+        headers["If-None-Match"] = etag.read_text()
+
+    response = _SESSION.get(_VERSIONS_URL, headers=headers, timeout=(5, 30))
+    if response.status_code == 304:
+        return json_loads(manifest.read_bytes())
+    response.raise_for_status()
+
+    if "ETag" in response.headers:
+        _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        manifest.write_bytes(response.content)
+        etag.write_text(response.headers["ETag"])
+    return json_loads(response.content)
 
 
 def get_github_python_versions():
-    versions_json = requests.get(_VERSIONS_URL).json()
-    raw_versions = [v["version"] for v in versions_json]
+    versions_json = get_versions_manifest()
     versions = []
-    for version_str in raw_versions:
+    for release in versions_json:
+        version_str = release["version"]
         if "-" in version_str:
             continue
 
@@ -38,7 +71,7 @@ if __name__ == "__main__":
         pathlib.Path(__file__).parent.parent / ".github" / "workflows" / "build.yml"
     )
 
-    transformed = []
+    transformed = io.StringIO()
     for line in open(build_yml):
         if line.startswith("        python-version: ["):
             newversions = f"        python-version: [{', '.join(v for v in versions)}]\n"
@@ -47,7 +80,10 @@ if __name__ == "__main__":
                 print("Old:", line)
                 print("New:", newversions)
             line = newversions
-        transformed.append(line)
+        transformed.write(line)
 
-    with open(build_yml, "w") as o:
-        o.write("".join(transformed))
+    # write to a temporary file and then move into place, so that build.yml
+    # is never left half written
+    tmp = build_yml.with_suffix(".yml.tmp")
+    tmp.write_bytes(transformed.getvalue().encode("utf-8"))
+    tmp.replace(build_yml)
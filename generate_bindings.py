@@ -5,45 +5,74 @@ compiler with rustfmt-nightly.
 
 Also requires a git repo of cpython to be checked out somewhere. As a hack, this can
 also build different versions of cpython for testing out
+
+Each version is checked out into its own git worktree under <cpython>/worktrees/<version>,
+which is reused between runs. Since the main checkout is never used directly, the cpython
+repo can be cloned with 'git clone --no-checkout' to save writing out an extra copy of it.
 """
 import argparse
+import functools
+import hashlib
 import os
+import subprocess
 import sys
 import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+
+def _usable_cpus():
+    # on linux this respects any cpu affinity we've been restricted to (like in a container),
+    # which os.cpu_count() doesn't
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _worktree_for(cpython_path, version):
+    # each version gets its own git worktree, so that we can process multiple
+    # versions at once without them fighting over a single checkout
+    path = os.path.abspath(os.path.join(cpython_path, "worktrees", version))
+    if not os.path.isdir(path):
+        # forget about any worktrees that have been deleted, otherwise git refuses to re-add them
+        subprocess.run(["git", "worktree", "prune"], cwd=cpython_path, check=True)
+        subprocess.run(["git", "worktree", "add", "--detach", path, version],
+                       cwd=cpython_path, check=True)
+    return path
 
 
-def build_python(cpython_path, version):
+def build_python(cpython_dir, version, install_path):
     # TODO: probably easier to use pyenv for this?
-    print("Compiling python %s from repo at %s" % (version, cpython_path))
-    install_path = os.path.abspath(os.path.join(cpython_path, version))
-
-    ret = os.system(f"""
-        cd {cpython_path}
-        git checkout {version}
-
-        # build in a subdirectory
-        mkdir -p build_{version}
-        cd build_{version}
-        ../configure prefix={install_path}
-        make
-        make install
-    """)
-    if ret:
-        return ret
+    print("Compiling python %s from %s" % (version, cpython_dir), flush=True)
+
+    # build in a subdirectory
+    build_path = os.path.join(cpython_dir, "build")
+    os.makedirs(build_path, exist_ok=True)
+    # several versions can be building at once, so also cap make by the load average
+    jobs = str(_usable_cpus())
+    for command in (["../configure", f"prefix={install_path}"],
+                    ["make", "-j", jobs, "-l", jobs],
+                    ["make", "install"]):
+        ret = subprocess.run(command, cwd=build_path).returncode
+        if ret:
+            return ret
 
     # also install setuptools_rust/wheel here for building packages
     pip = os.path.join(install_path, "bin", "pip3" if version.startswith("v3") else "pip")
-    return os.system(f"{pip} install setuptools_rust wheel")
+    return subprocess.run([pip, "install", "setuptools_rust", "wheel"]).returncode
 
 
-def calculate_pyruntime_offsets(cpython_path, version, configure=False):
-    ret = os.system(f"""cd {cpython_path} && git checkout {version}""")
-    if ret:
-        return ret
+def _pyruntime_offsets_cache(cpython_dir, program, pystate_header):
+    # the offsets only depend on the headers, so we can reuse the last output if they
+    # haven't changed
+    digest = hashlib.blake2b(program.encode("utf8"), digest_size=16)
+    for header in ["pyconfig.h", os.path.join("Include", "Python.h"), pystate_header]:
+        if os.path.isfile(os.path.join(cpython_dir, header)):
+            with open(os.path.join(cpython_dir, header), "rb") as f:
+                digest.update(f.read())
+    return os.path.join(cpython_dir, f"pyruntime_offsets_{digest.hexdigest()}.txt")
 
-    if configure:
-        os.system(f"cd {cpython_path} && ./configure prefix=" + os.path.abspath(os.path.join(cpython_path, version)))
 
+def calculate_pyruntime_offsets(cpython_dir, version, install_path, configure=False):
     # simple little c program to get the offsets we need from the pyruntime struct
     # (using rust bindgen here is more complicated than necessary)
     program = r"""
@@ -62,17 +91,31 @@ def calculate_pyruntime_offsets(cpython_path, version, configure=False):
         }
     """
 
-    if not os.path.isfile(os.path.join(cpython_path, "Include", "internal", "pystate.h")):
-        if os.path.isfile(os.path.join(cpython_path, "Include", "internal", "pycore_pystate.h")):
+    pystate_header = os.path.join("Include", "internal", "pystate.h")
+    if not os.path.isfile(os.path.join(cpython_dir, pystate_header)):
+        if os.path.isfile(os.path.join(cpython_dir, "Include", "internal", "pycore_pystate.h")):
             program = program.replace("pystate.h", "pycore_pystate.h")
+            pystate_header = os.path.join("Include", "internal", "pycore_pystate.h")
         else:
-            print("failed to find Include/internal/pystate.h in cpython directory =(")
+            print("failed to find Include/internal/pystate.h in cpython directory =(", flush=True)
             return
 
+    if configure:
+        ret = subprocess.run(["./configure", f"prefix={install_path}"], cwd=cpython_dir).returncode
+        if ret:
+            return ret
+
+    # the cache is keyed on pyconfig.h, so this has to come after running configure
+    cache_filename = _pyruntime_offsets_cache(cpython_dir, program, pystate_header)
+    if os.path.isfile(cache_filename):
+        with open(cache_filename) as f:
+            print(f"// {version}\n{f.read()}", end="", flush=True)
+        return
+
     with tempfile.TemporaryDirectory() as path:
         if sys.platform.startswith("win"):
             source_filename = os.path.join(path, "pyruntime_offsets.cpp")
-            exe = os.path.join("pyruntime_offsets.exe")
+            exe = os.path.join(path, "pyruntime_offsets.exe")
         else:
             source_filename = os.path.join(path, "pyruntime_offsets.c")
             exe = os.path.join(path, "pyruntime_offsets")
@@ -82,68 +125,106 @@ def calculate_pyruntime_offsets(cpython_path, version, configure=False):
         if sys.platform.startswith("win"):
             # this requires a 'x64 Native Tools Command Prompt' to work out properly for 64 bit installs
             # also expects that you have run something like 'PCBuild\build.bat' first
-            ret = os.system(f"cl {source_filename} /I {cpython_path} /I {cpython_path}\PC /I {cpython_path}\Include")
-        elif sys.platform.startswith("freebsd"):
-            ret = os.system(f"""cc {source_filename} -I {cpython_path} -I {cpython_path}/Include -o {exe}""")
+            # (cl writes the exe to the current directory, so run it from the temp dir)
+            command = ["cl", source_filename, "/I", cpython_dir,
+                       "/I", os.path.join(cpython_dir, "PC"),
+                       "/I", os.path.join(cpython_dir, "Include")]
         else:
-            ret = os.system(f"""gcc {source_filename} -I {cpython_path} -I {cpython_path}/Include -o {exe}""")
+            compiler = "cc" if sys.platform.startswith("freebsd") else "gcc"
+            # we only need the offsetof values, so don't spend any time optimizing
+            command = [compiler, source_filename, "-O0", "-pipe", "-I", cpython_dir,
+                       "-I", os.path.join(cpython_dir, "Include"), "-o", exe]
+        ret = subprocess.run(command, cwd=path).returncode
         if ret:
-            print("Failed to compile""")
+            print("Failed to compile""", flush=True)
             return ret
 
-        ret = os.system(exe)
+        # capture the output so that offsets from different versions don't get interleaved
+        result = subprocess.run([exe], stdout=subprocess.PIPE, universal_newlines=True)
+        if result.returncode:
+            print("Failed to run pyruntime file", flush=True)
+            return result.returncode
+        print(f"// {version}\n{result.stdout}", end="", flush=True)
+
+    with open(cache_filename, "w") as o:
+        o.write(result.stdout)
+
+
+def _append_headers(o, cpython_dir, headers):
+    # older versions of python don't have all the internal headers, skip those
+    for header in headers:
+        filename = os.path.join(cpython_dir, header)
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                o.write(f.read())
+
+
+def _file_digest(filename):
+    with open(filename, "rb") as f:
+        return hashlib.blake2b(f.read()).hexdigest()
+
+
+def extract_bindings(cpython_dir, version, install_path, configure=False):
+    print("Generating bindings for python %s from %s" % (version, cpython_dir), flush=True)
+
+    # need to run configure on the current branch to generate pyconfig.h sometimes
+    if configure:
+        ret = subprocess.run(["./configure", f"prefix={install_path}"], cwd=cpython_dir).returncode
         if ret:
-            print("Failed to run pyruntime file")
             return ret
 
-
-def extract_bindings(cpython_path, version, configure=False):
-    print("Generating bindings for python %s from repo at %s" % (version, cpython_path))
-
-    ret = os.system(f"""
-        cd {cpython_path}
-        git checkout {version}
-
-        # need to run configure on the current branch to generate pyconfig.h sometimes
-        {("./configure prefix=" + os.path.abspath(os.path.join(cpython_path, version))) if configure else ""}
-
-        cat Include/Python.h > bindgen_input.h
-        cat Include/frameobject.h >> bindgen_input.h
-        cat Objects/dict-common.h >> bindgen_input.h
-        echo '#define Py_BUILD_CORE 1\n' >> bindgen_input.h
-        cat Include/internal/pycore_pystate.h >> bindgen_input.h
-        cat Include/internal/pycore_interp.h >> bindgen_input.h
-
-        bindgen  bindgen_input.h -o bindgen_output.rs \
-            --with-derive-default \
-            --no-layout-tests --no-doc-comments \
-            --whitelist-type PyInterpreterState \
-            --whitelist-type PyFrameObject \
-            --whitelist-type PyThreadState \
-            --whitelist-type PyCodeObject \
-            --whitelist-type PyVarObject \
-            --whitelist-type PyBytesObject \
-            --whitelist-type PyASCIIObject \
-            --whitelist-type PyUnicodeObject \
-            --whitelist-type PyCompactUnicodeObject \
-            --whitelist-type PyStringObject \
-            --whitelist-type PyTupleObject \
-            --whitelist-type PyListObject \
-            --whitelist-type PyIntObject \
-            --whitelist-type PyLongObject \
-            --whitelist-type PyFloatObject \
-            --whitelist-type PyDictObject \
-            --whitelist-type PyDictKeysObject \
-            --whitelist-type PyDictKeyEntry \
-            --whitelist-type PyObject \
-            --whitelist-type PyTypeObject \
-             -- -I . -I ./Include -I ./Include/internal
-    """)
+    with open(os.path.join(cpython_dir, "bindgen_input.h"), "w") as o:
+        _append_headers(o, cpython_dir, ["Include/Python.h", "Include/frameobject.h",
+                                         "Objects/dict-common.h"])
+        o.write("#define Py_BUILD_CORE 1\n\n")
+        _append_headers(o, cpython_dir, ["Include/internal/pycore_pystate.h",
+                                         "Include/internal/pycore_interp.h"])
+
+    command = ["bindgen", "bindgen_input.h", "-o", "bindgen_output.rs",
+               "--with-derive-default", "--no-layout-tests", "--no-doc-comments"]
+    # bindgen anchors each pattern, so a single alternation only matches these exact types
+    typenames = ["PyInterpreterState", "PyFrameObject", "PyThreadState", "PyCodeObject",
+                 "PyVarObject", "PyBytesObject", "PyASCIIObject", "PyUnicodeObject",
+                 "PyCompactUnicodeObject", "PyStringObject", "PyTupleObject", "PyListObject",
+                 "PyIntObject", "PyLongObject", "PyFloatObject", "PyDictObject",
+                 "PyDictKeysObject", "PyDictKeyEntry", "PyObject", "PyTypeObject"]
+    command.extend(["--allowlist-type", "(%s)" % "|".join(typenames)])
+    command.extend(["--", "-I", ".", "-I", "./Include", "-I", "./Include/internal"])
+
+    # skip running bindgen if neither the headers nor the bindgen arguments have changed
+    # since we last generated these bindings, and the generated file hasn't been touched since.
+    # bindgen_input.h is mostly #include lines, so hash the preprocessed input to pick up
+    # every header it includes - as well as the pyconfig.h that configure may have just written
+    output_filename = os.path.join("src", "python_bindings", version.replace(".", "_") + ".rs")
+    digest = hashlib.blake2b("\0".join(command).encode("utf8"))
+    for header in ["bindgen_input.h", "pyconfig.h"]:
+        if os.path.isfile(os.path.join(cpython_dir, header)):
+            with open(os.path.join(cpython_dir, header), "rb") as f:
+                digest.update(f.read())
+    # bindgen only needs libclang, so there might not be a clang binary to preprocess with
+    try:
+        preprocessed = subprocess.run(["clang", "-E", "bindgen_input.h"] +
+                                      command[command.index("--") + 1:],
+                                      cwd=cpython_dir, stdout=subprocess.PIPE,
+                                      stderr=subprocess.DEVNULL)
+        if preprocessed.returncode == 0:
+            digest.update(preprocessed.stdout)
+    except FileNotFoundError:
+        pass
+    digest = digest.hexdigest()
+    hash_filename = os.path.join(cpython_dir, "bindgen_input.hash")
+    if os.path.isfile(hash_filename) and os.path.isfile(output_filename):
+        with open(hash_filename) as f:
+            if f.read() == f"{digest} {_file_digest(output_filename)}":
+                print("Bindings for python %s are already up to date" % version, flush=True)
+                return
+
+    ret = subprocess.run(command, cwd=cpython_dir).returncode
     if ret:
         return ret
 
     # write the file out to the appropiate place, disabling some warnings
-    with open(os.path.join("src", "python_bindings", version.replace(".", "_") + ".rs"), "w") as o:
+    with open(output_filename, "w") as o:
         o.write(f"// Generated bindings for python {version}\n")
         o.write("#![allow(dead_code)]\n")
         o.write("#![allow(non_upper_case_globals)]\n")
@@ -153,7 +234,36 @@ def extract_bindings(cpython_path, version, configure=False):
         o.write("#![allow(clippy::default_trait_access)]\n")
         o.write("#![allow(clippy::cast_lossless)]\n")
         o.write("#![allow(clippy::trivially_copy_pass_by_ref)]\n\n")
-        o.write(open(os.path.join(cpython_path, "bindgen_output.rs")).read())
+        o.write(open(os.path.join(cpython_dir, "bindgen_output.rs")).read())
+
+    with open(hash_filename, "w") as o:
+        o.write(f"{digest} {_file_digest(output_filename)}")
+
+
+def _worker(args, version):
+    if args.build:
+        # todo: this probably should be a separate script
+        message, func = "Failed to build python %s", build_python
+    elif args.pyruntime:
+        message = "Failed to calculate pyruntime offsets for python %s"
+        func = functools.partial(calculate_pyruntime_offsets, configure=args.configure)
+    else:
+        message = "Failed to generate bindings for python %s"
+        func = functools.partial(extract_bindings, configure=args.configure)
+    message = message % version
+
+    # report errors here rather than letting them escape the process pool, so that
+    # one bad version doesn't stop the rest from being processed
+    try:
+        cpython_dir = _worktree_for(args.cpython, version)
+        install_path = os.path.abspath(os.path.join(args.cpython, version))
+        ret = func(cpython_dir, version, install_path)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"{message}: {e}", flush=True)
+        return
+
+    if ret:
+        print(message, flush=True)
 
 
 if __name__ == "__main__":
@@ -197,14 +307,16 @@ if __name__ == "__main__":
             print("You must specify versions of cpython to generate bindings for, or --all\n")
             parser.print_help()
 
+    # check out each version once up front, rather than having the workers all
+    # modify the cpython repo's worktree list at the same time
+    checked_out = []
     for version in versions:
-        if args.build:
-            # todo: this probably should be a separate script
-            if build_python(args.cpython, version):
-                print("Failed to build python")
-        elif args.pyruntime:
-            calculate_pyruntime_offsets(args.cpython, version, configure=args.configure)
-
-        else:
-            if extract_bindings(args.cpython, version, configure=args.configure):
-                print("Failed to generate bindings")
+        try:
+            _worktree_for(args.cpython, version)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"Failed to check out python {version}: {e}", flush=True)
+            continue
+        checked_out.append(version)
+
+    with ProcessPoolExecutor(max_workers=max(1, min(len(checked_out), _usable_cpus()))) as executor:
+        list(executor.map(functools.partial(_worker, args), checked_out))